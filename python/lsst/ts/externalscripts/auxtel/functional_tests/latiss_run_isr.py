@@ -76,6 +76,14 @@ class LatissRunIsr(salobj.BaseScript):
         self.isr_config.doSaturation = False
         self.isr_config.doWrite = False
 
+        self.isr_task = IsrTask(config=self.isr_config)
+
+        # Butler instance, created on first use and reused by later calls
+        self._butler = None
+
+        # time to wait before polling the butler again for an image (sec)
+        self.data_pool_sleep = 5.0
+
     def get_isr_exposure(self, exp_id):
         """Get ISR corrected exposure.
 
@@ -89,17 +97,17 @@ class LatissRunIsr(salobj.BaseScript):
         ISR corrected exposure as an lsst.afw.image.exposure.exposure object
         """
 
-        isrTask = IsrTask(config=self.isr_config)
-
         got_exposure = False
 
         ntries = 0
 
         data_ref = None
+        if self._butler is None:
+            self._butler = dafPersist.Butler(self.dataPath)
+
         while not got_exposure:
-            butler = dafPersist.Butler(self.dataPath)
             try:
-                data_ref = butler.dataRef("raw", **dict(expId=exp_id))
+                data_ref = self._butler.dataRef("raw", **dict(expId=exp_id))
             except RuntimeError as e:
                 self.log.warning(
                     f"Could not get intra focus image from butler. Waiting "
@@ -113,7 +121,7 @@ class LatissRunIsr(salobj.BaseScript):
                 got_exposure = True
 
         if data_ref is not None:
-            return isrTask.runDataRef(data_ref).exposure
+            return self.isr_task.runDataRef(data_ref).exposure
         else:
             raise RuntimeError(f"No data ref for {exp_id}.")
 
@@ -150,6 +158,12 @@ class LatissRunIsr(salobj.BaseScript):
 
         self.config = config
 
+        # The butler is created once for this data path, on the first call
+        # to get_isr_exposure, and reused for every retry.
+        if config.dataPath != self.dataPath:
+            self.dataPath = config.dataPath
+            self._butler = None
+
     def set_metadata(self, metadata):
         metadata.duration = 60.0
 
@@ -22,21 +22,21 @@ __all__ = ["LatissAcquireAndTakeSequence"]
 
 import asyncio
 import collections.abc
+import datetime
+import functools
+import math
 import warnings
 
 import lsst.daf.persistence as dafPersist
 import numpy as np
 import yaml
 import concurrent.futures
-from astropy import time as astropytime
-from lsst.geom import PointD
+from lsst.geom import Box2I, Extent2I, Point2I, PointD
 from lsst.ts import salobj
 from lsst.ts.observatory.control.auxtel import ATCS, LATISS
 from lsst.ts.observatory.control.constants import latiss_constants
 from lsst.ts.observatory.control.utils import RotType
 
-from lsst.ts.standardscripts.utils import format_as_list
-
 try:
     from lsst.ts.observing.utilities.auxtel.latiss.utils import (
         calculate_xy_offsets,
@@ -48,6 +48,51 @@ except ImportError:
     warnings.warn("Cannot import required libraries. Script will not work.")
 
 STD_TIMEOUT = 10  # seconds
+# Half size of the cutout used to find the target once it is expected to
+# be close to the desired position (pixels)
+QM_ROI_HALF_SIZE = 512
+
+
+def broadcast_sequence(value, recurrences):
+    """Broadcast a scalar or sequence to a 1-d array of a given length.
+
+    Parameters
+    ----------
+    value : ``any`` or `list` [``any``]
+        Value to broadcast. A scalar or a single element sequence is
+        repeated, a longer sequence must have ``recurrences`` elements.
+    recurrences : `int`
+        Required number of elements.
+
+    Returns
+    -------
+    array : `numpy.ndarray`
+        Read-only 1-dimensional array with ``recurrences`` elements.
+
+    Raises
+    ------
+    ValueError
+        If ``value`` is a sequence that cannot be broadcast to
+        ``recurrences`` elements.
+    """
+    try:
+        return np.broadcast_to(np.asarray(value), (recurrences,))
+    except ValueError:
+        raise ValueError(
+            f"Size of {value} does not match the required size of {recurrences}."
+        )
+
+
+@functools.lru_cache(maxsize=1)
+def _get_quick_frame_measurement_task():
+    """Return the quick frame measurement task shared by all instances.
+
+    Raises
+    ------
+    NameError
+        If the task could not be imported.
+    """
+    return QuickFrameMeasurementTask(config=QuickFrameMeasurementTask.ConfigClass())
 
 
 class LatissAcquireAndTakeSequence(salobj.BaseScript):
@@ -76,6 +121,9 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
 
     __test__ = False  # stop pytest from warning that this is not a test
 
+    # Parsed configuration schema, cached by `get_schema`.
+    _schema = None
+
     def __init__(self, index, silent=False):
 
         super().__init__(
@@ -90,12 +138,19 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
             log=self.log,
             tcs_ready_to_take_data=self.atcs.ready_to_take_data,
         )
-        # instantiate the quick measurement class
+        # get the quick measurement task. It keeps no state between runs,
+        # so a single instance is shared by all scripts in the process.
         try:
-            qm_config = QuickFrameMeasurementTask.ConfigClass()
-            self.qm = QuickFrameMeasurementTask(config=qm_config)
+            self.qm = _get_quick_frame_measurement_task()
         except NameError:
             self.log.warning("Library unavailable certain tests will be skipped")
+
+        # Single worker executor used to run the blocking centroid finding
+        # without having to spawn new threads on every iteration.
+        self._qm_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="qm"
+        )
+
         # Set timeout
         self.cmd_timeout = 30  # [s]
 
@@ -104,6 +159,10 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
 
     @classmethod
     def get_schema(cls):
+        # The schema is static, so it only needs to be parsed once.
+        if cls._schema is not None:
+            return cls._schema
+
         schema_yaml = """
             $schema: http://json-schema.org/draft-07/schema#
             $id: https://github.com/lsst-ts/ts_externalscripts/auxtel/latiss_acquire_and_take_sequence.yaml
@@ -141,9 +200,11 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
                     - type: "null"
 
               manual_focus_offset:
-                description: Applies manual focus offset after the slew. This
-                    is temporary in order to observe low-altitude stars until
-                    the ATAOS LUTs improve.
+                description: Applies manual focus offset together with the
+                    slew, or before the sequence if no acquisition is done.
+                    It is removed at the end of the acquisition or of the
+                    sequence. This is temporary in order to observe
+                    low-altitude stars until the ATAOS LUTs improve.
                 type: number
                 default: 0.0
 
@@ -244,7 +305,8 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
             else:
               required: ["object_name", "object_ra", "object_dec"]
         """
-        return yaml.safe_load(schema_yaml)
+        cls._schema = yaml.safe_load(schema_yaml)
+        return cls._schema
 
     async def configure(self, config):
         """Configure script.
@@ -283,6 +345,13 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
         self.manual_focus_offset = config.manual_focus_offset
         self.manual_focus_offset_applied = False
 
+        # Detector position where the target is placed by the acquisition.
+        # Gratings without a sweet spot only fail if an acquisition is run.
+        if self.do_pointing_model:
+            self.target_position = latiss_constants.boresight
+        else:
+            self.target_position = latiss_constants.sweet_spots.get(self.acq_grating)
+
         # Max number of iterations to perform when putting source in place
         self.max_acq_iter = config.max_acq_iter
 
@@ -300,30 +369,28 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
         # make a list of tuples from the filter, exptime and grating lists
         _recurrences = (
             len(config.exposure_time_sequence)
-            if isinstance(config.exposure_time_sequence, collections.Iterable)
+            if isinstance(config.exposure_time_sequence, collections.abc.Sequence)
             else 1
         )
 
-        self.visit_configs = [
-            (f, e, g)
-            for f, e, g in zip(
-                format_as_list(config.filter_sequence, _recurrences),
-                format_as_list(config.exposure_time_sequence, _recurrences),
-                format_as_list(config.grating_sequence, _recurrences),
-            )
-        ]
+        filters = broadcast_sequence(config.filter_sequence, _recurrences)
+        exposure_times = broadcast_sequence(config.exposure_time_sequence, _recurrences)
+        gratings = broadcast_sequence(config.grating_sequence, _recurrences)
+
+        self.visit_configs = list(
+            zip(filters.tolist(), exposure_times.tolist(), gratings.tolist())
+        )
+
+        # Summary of the sequence, used by set_metadata
+        self.sequence_filters = set(filters.tolist())
+        self.sequence_gratings = set(gratings.tolist())
 
     # This bit is required for ScriptQueue
     # Does the calculation below need acquisition times?
     # I'm not quite sure what the metadata.filter bit is used for...
     def set_metadata(self, metadata):
         metadata.duration = 300
-        filters, gratings, expTimeTotal = set(), set(), 0
-        for (filt, expTime, grating) in self.visit_configs:
-            expTimeTotal += expTime
-            filters.add(filt)
-            gratings.add(grating)
-        metadata.filter = f"{filters},{gratings}"
+        metadata.filter = f"{self.sequence_filters},{self.sequence_gratings}"
 
     async def get_next_image_data_id(self, timeout=STD_TIMEOUT, flush=True):
         """Return dataID of image that appears from the ATArchiver CSC.
@@ -350,12 +417,45 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
 
         return data_id
 
+    def get_roi_cutout(self, exp, position, half_size=QM_ROI_HALF_SIZE):
+        """Return a cutout of an exposure centered on a given position.
+
+        Parameters
+        ----------
+        exp : `lsst.afw.image.Exposure`
+            Exposure to cut.
+        position : `lsst.geom.PointD`
+            Center of the cutout (pixels).
+        half_size : `int`, optional
+            Half size of the cutout side (pixels).
+
+        Returns
+        -------
+        cutout : `lsst.afw.image.Exposure`
+            Copy of the region of ``exp`` clipped to its bounding box, with
+            its origin reset to (0, 0).
+        origin : `lsst.geom.Point2I`
+            Position of the cutout origin in ``exp``. Add it to positions
+            measured on ``cutout`` to get positions in ``exp``.
+        """
+        bbox = Box2I(
+            Point2I(int(position[0]) - half_size, int(position[1]) - half_size),
+            Extent2I(2 * half_size, 2 * half_size),
+        )
+        bbox.clip(exp.getBBox())
+        # Reset the origin of the cutout, so the measured centroid is
+        # always relative to it, and translate it explicitly.
+        cutout = exp[bbox].clone()
+        cutout.setXY0(Point2I(0, 0))
+        return cutout, bbox.getMin()
+
     async def latiss_acquire(self):
 
-        if self.do_pointing_model:
-            target_position = latiss_constants.boresight
-        else:
-            target_position = latiss_constants.sweet_spots[self.acq_grating]
+        target_position = self.target_position
+        if target_position is None:
+            raise RuntimeError(
+                f"No sweet spot defined for acquisition grating {self.acq_grating}."
+            )
 
         # Find offsets to desired detector position, calculate blind offset
         # and send as part of the slew command
@@ -367,9 +467,13 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
                 current_position, target_position
             )
             self.log.debug(
-                f"After slew, the target should be at the boresight [{current_position}] whereas the "
-                f"target position is {target_position}. Blindly offsetting"
-                f" [{dx_arcsec:0.1f}, {dy_arcsec:0.1f}] arcsec to this position."
+                "After slew, the target should be at the boresight [%s] whereas the "
+                "target position is %s. Blindly offsetting"
+                " [%0.1f, %0.1f] arcsec to this position.",
+                current_position,
+                target_position,
+                dx_arcsec,
+                dy_arcsec,
             )
         else:
             dx_arcsec, dy_arcsec = 0.0, 0.0
@@ -400,39 +504,81 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
                 offset_y=dy_arcsec,
             )
 
-        tmp, data = await asyncio.gather(
-            _slew_coro,
-            self.latiss.setup_atspec(grating=self.acq_grating, filter=self.acq_filter),
-        )
-
-        # Apply manual focus offset if required
-        if self.manual_focus_offset != 0.0 and not self.manual_focus_offset_applied:
+        async def apply_manual_focus_offset():
             self.log.debug(
-                "Applying manual focus offset of " f"{self.manual_focus_offset}"
+                "Applying manual focus offset of %s", self.manual_focus_offset
             )
             await self.atcs.rem.ataos.cmd_offset.set_start(z=self.manual_focus_offset)
             self.manual_focus_offset_applied = True
 
+        # Apply manual focus offset if required. This does not depend on the
+        # instrument setup so it is sent together with the slew.
+        focus_offset_task = None
+        if self.manual_focus_offset != 0.0 and not self.manual_focus_offset_applied:
+            focus_offset_task = asyncio.create_task(apply_manual_focus_offset())
+
+        try:
+            tmp, data = await asyncio.gather(
+                _slew_coro,
+                self.latiss.setup_atspec(
+                    grating=self.acq_grating, filter=self.acq_filter
+                ),
+            )
+            if focus_offset_task is not None:
+                await focus_offset_task
+        except BaseException:
+            # The focus offset keeps running if the slew or the instrument
+            # setup fails, so wait for it to finish and remove it if it was
+            # applied.
+            if focus_offset_task is not None:
+                await asyncio.gather(focus_offset_task, return_exceptions=True)
+            if self.manual_focus_offset_applied:
+                self.log.debug(
+                    "Removing manual focus offset of %s before raising error",
+                    self.manual_focus_offset,
+                )
+                self.manual_focus_offset_applied = False
+                await asyncio.shield(
+                    self.atcs.rem.ataos.cmd_offset.set_start(
+                        z=-self.manual_focus_offset
+                    )
+                )
+            raise
+
         self.log.info(
             "Beginning Acquisition Iterative Loop, with a maximum amount of "
             f"iterations set to {self.max_acq_iter}"
         )
         iter_num = 0
         _success = False
+        # Was not catching event from OODS in time without timing out.
+        # Flushing once is enough, each iteration below consumes exactly the
+        # one imageInOODS event generated by its own take_object.
+        self.latiss.rem.atarchiver.evt_imageInOODS.flush()
         for iter_num in range(self.max_acq_iter):
             # Take image
             self.log.debug(
-                f"\nStarting iteration number {iter_num + 1}, with a "
-                f"maximum of {self.max_acq_iter}"
+                "\nStarting iteration number %s, with a maximum of %s",
+                iter_num + 1,
+                self.max_acq_iter,
             )
 
-            # Was not catching event from OODS in time without timing out
-            self.latiss.rem.atarchiver.evt_imageInOODS.flush()
-            tmp = await self.latiss.take_object(exptime=self.acq_exposure_time, n=1)
-            data_id = await self.get_next_image_data_id(
-                timeout=self.acq_exposure_time + STD_TIMEOUT, flush=False
+            # Start waiting for the image to arrive in the OODS before taking
+            # it, so the event is caught as soon as it is published. The
+            # timeout also has to cover the take_object command itself.
+            oods_task = asyncio.create_task(
+                self.get_next_image_data_id(
+                    timeout=self.acq_exposure_time + self.cmd_timeout + STD_TIMEOUT,
+                    flush=False,
+                )
             )
-            self.log.debug(f"Take Object returned {tmp}")
+            try:
+                tmp = await self.latiss.take_object(exptime=self.acq_exposure_time, n=1)
+            except Exception:
+                oods_task.cancel()
+                raise
+            data_id = await oods_task
+            self.log.debug("Take Object returned %s", tmp)
             self.log.debug("Now waiting for image to land in OODS")
 
             exp = await get_image(
@@ -442,10 +588,19 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
                 runBestEffortIsr=True,
             )
 
-            # Find brightest star
-            loop = asyncio.get_event_loop()
-            executor = concurrent.futures.ThreadPoolExecutor()
-            result = await loop.run_in_executor(executor, self.qm.run, exp)
+            # Find brightest star. After the first iteration the target is
+            # expected to be near the desired position, so only measure a
+            # cutout around it and fall back to the full frame if needed.
+            loop = asyncio.get_running_loop()
+            result = None
+            if iter_num > 0:
+                cutout, origin = self.get_roi_cutout(exp, target_position)
+                result = await loop.run_in_executor(
+                    self._qm_executor, self.qm.run, cutout
+                )
+            if result is None or not result.success:
+                origin = Point2I(0, 0)
+                result = await loop.run_in_executor(self._qm_executor, self.qm.run, exp)
             # Verify a result was achieved, if not then remove focus
             # offset before raising the exception
             if not result.success:
@@ -453,8 +608,8 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
                 # raising an exception
                 if self.manual_focus_offset_applied:
                     self.log.debug(
-                        "Removing manual focus offset of "
-                        f"{self.manual_focus_offset} before raising error"
+                        "Removing manual focus offset of %s before raising error",
+                        self.manual_focus_offset,
                     )
                     await self.atcs.rem.ataos.cmd_offset.set_start(
                         z=-self.manual_focus_offset
@@ -463,20 +618,23 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
                 raise RuntimeError("Centroid finding algorithm was unsuccessful.")
 
             current_position = PointD(
-                result.brightestObjCentroid[0], result.brightestObjCentroid[1]
+                result.brightestObjCentroid[0] + origin.getX(),
+                result.brightestObjCentroid[1] + origin.getY(),
             )
 
             # Find offsets to desired position
             self.log.debug(
-                f"Current brightest target position is {current_position} whereas the "
-                f"target position is {target_position}"
+                "Current brightest target position is %s whereas the "
+                "target position is %s",
+                current_position,
+                target_position,
             )
 
             dx_arcsec, dy_arcsec = calculate_xy_offsets(
                 current_position, target_position
             )
 
-            dr_arcsec = np.sqrt(dx_arcsec ** 2 + dy_arcsec ** 2)
+            dr_arcsec = math.hypot(dx_arcsec, dy_arcsec)
 
             self.log.info(
                 f"Calculated offsets [dx,dy] are [{dx_arcsec:0.2f}, {dy_arcsec:0.2f}] arcsec as calculated"
@@ -515,14 +673,15 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
         if not _success:
             self.log.debug(
                 "Failed to acquire star on target after "
-                f"{iter_num} images. Removing focus offset and "
-                "raising an exception"
+                "%s images. Removing focus offset and "
+                "raising an exception",
+                iter_num,
             )
             # Remove the focus offset if only an acquisition is performed
             if self.manual_focus_offset_applied:
                 self.log.debug(
-                    "Removing manual focus offset of "
-                    f"{self.manual_focus_offset} in after acquisition"
+                    "Removing manual focus offset of %s in after acquisition",
+                    self.manual_focus_offset,
                 )
                 await self.atcs.rem.ataos.cmd_offset.set_start(
                     z=-self.manual_focus_offset
@@ -550,8 +709,8 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
         # Remove the focus offset if only an acquisition is performed
         if self.manual_focus_offset_applied and not self.do_take_sequence:
             self.log.debug(
-                "Removing manual focus offset of "
-                f"{self.manual_focus_offset} in after acquisition"
+                "Removing manual focus offset of %s in after acquisition",
+                self.manual_focus_offset,
             )
             await self.atcs.rem.ataos.cmd_offset.set_start(z=-self.manual_focus_offset)
             self.manual_focus_offset_applied = False
@@ -560,19 +719,24 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
         """Take the sequence of images as defined in visit_configs."""
 
         nexp = len(self.visit_configs)
-        group_id = astropytime.Time.now().tai.isot
-        for i, (filt, expTime, grating) in enumerate(self.visit_configs):
+        # Same format as astropy Time.now().tai.isot, without the overhead
+        # of creating an astropy Time object.
+        tai = datetime.datetime.fromtimestamp(
+            salobj.current_tai(), datetime.timezone.utc
+        )
+        group_id = tai.replace(tzinfo=None).isoformat(timespec="milliseconds")
 
-            # Check if a manual focus offset is required
-            if self.manual_focus_offset != 0.0 and not self.manual_focus_offset_applied:
-                self.log.debug(
-                    "Applying manual focus offset of "
-                    f"{self.manual_focus_offset} in latiss_take_sequence"
-                )
-                await self.atcs.rem.ataos.cmd_offset.set_start(
-                    z=self.manual_focus_offset
-                )
-                self.manual_focus_offset_applied = True
+        # Check if a manual focus offset is required. This only needs to be
+        # done once, before the first exposure of the sequence.
+        if self.manual_focus_offset != 0.0 and not self.manual_focus_offset_applied:
+            self.log.debug(
+                "Applying manual focus offset of %s in latiss_take_sequence",
+                self.manual_focus_offset,
+            )
+            await self.atcs.rem.ataos.cmd_offset.set_start(z=self.manual_focus_offset)
+            self.manual_focus_offset_applied = True
+
+        for i, (filt, expTime, grating) in enumerate(self.visit_configs):
 
             # Focus and pointing offsets will be made automatically
             # by the TCS upon filter/grating changes
@@ -590,8 +754,8 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
         # Remove the focus offset if applied
         if self.manual_focus_offset_applied:
             self.log.debug(
-                "Removing manual focus offset of "
-                f"{self.manual_focus_offset} in after acquisition"
+                "Removing manual focus offset of %s in after acquisition",
+                self.manual_focus_offset,
             )
             await self.atcs.rem.ataos.cmd_offset.set_start(z=-self.manual_focus_offset)
             self.manual_focus_offset_applied = False
@@ -609,12 +773,29 @@ class LatissAcquireAndTakeSequence(salobj.BaseScript):
                 await self.checkpoint("Beginning taking data for target sequence")
             try:
                 await self.latiss_take_sequence()
-            except Exception as e:
+            except BaseException:
                 self.log.exception("Exception from latiss_take_sequence()")
-                raise e
+                # Remove the focus offset if applied. Shield the command so
+                # it still completes if the script is being stopped.
+                if self.manual_focus_offset_applied:
+                    self.log.debug(
+                        "Removing manual focus offset of %s before raising error",
+                        self.manual_focus_offset,
+                    )
+                    self.manual_focus_offset_applied = False
+                    await asyncio.shield(
+                        self.atcs.rem.ataos.cmd_offset.set_start(
+                            z=-self.manual_focus_offset
+                        )
+                    )
+                raise
             finally:
                 self.log.debug("At finally statement in run")
 
     async def run(self):
         """"""
         await self.arun(checkpoint=True)
+
+    async def close_tasks(self):
+        await super().close_tasks()
+        self._qm_executor.shutdown(wait=False)
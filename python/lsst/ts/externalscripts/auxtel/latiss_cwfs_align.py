@@ -23,9 +23,12 @@ __all__ = ["LatissCWFSAlign"]
 import os
 import yaml
 import asyncio
+import importlib.util
+import tempfile
 import warnings
 import concurrent.futures
 import functools
+import math
 import numpy as np
 
 from pathlib import Path
@@ -43,21 +46,40 @@ try:
 except ImportError:
     warnings.warn("Cannot import required libraries. Script will not work.")
 
-# Import CWFS package
+# The CWFS package is slow to import, so it is only imported where it is
+# used. Just check that it is available here.
+# TODO: (DM-24904) Remove this check when WEP is adopted
 try:
-    # TODO: (DM-24904) Remove this try/except clause when WEP is adopted
-    from lsst import cwfs
-    from lsst.cwfs.instrument import Instrument
-    from lsst.cwfs.algorithm import Algorithm
-    from lsst.cwfs.image import Image
+    if importlib.util.find_spec("lsst.cwfs") is None:
+        raise ImportError
 except ImportError:
     warnings.warn("Could not import cwfs code.")
 
-import copy  # used to support binning
-
 STD_TIMEOUT = 10  # seconds to perform ISR
 
 
+@functools.lru_cache(maxsize=None)
+def get_cwfs_config_dir(config_index):
+    """Get the directory where cwfs looks for an instrument configuration,
+    creating it if needed.
+
+    Parameters
+    ----------
+    config_index : `str`
+        Name of the cwfs instrument configuration.
+
+    Returns
+    -------
+    path : `pathlib.Path`
+        Absolute path to the configuration directory.
+    """
+    from lsst import cwfs
+
+    path = Path(cwfs.__file__).resolve().parents[3].joinpath("data", config_index)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
 class LatissCWFSAlign(salobj.BaseScript):
     """Perform an optical alignment procedure of Auxiliary Telescope with
     the LATISS instrument (ATSpectrograph and ATCamera CSCs). This is for
@@ -105,13 +127,23 @@ class LatissCWFSAlign(salobj.BaseScript):
                 tcs_ready_to_take_data=self.atcs.ready_to_take_data,
             )
 
-        # instantiate the quick measurement class
+        # instantiate the quick measurement class. A separate instance is
+        # used for the extra-focal image so the intra and extra images can
+        # be measured concurrently without sharing task state.
         try:
             qm_config = QuickFrameMeasurementTask.ConfigClass()
             self.qm = QuickFrameMeasurementTask(config=qm_config)
+            self.qm_extra = QuickFrameMeasurementTask(config=qm_config)
         except NameError:
             self.log.warning("Library unavailable certain tests will be skipped")
 
+        # Executor for the blocking source detection and CWFS calculations.
+        # Two workers so the intra and extra images can be measured at the
+        # same time.
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="cwfs"
+        )
+
         # Timeouts used for telescope commands
         self.short_timeout = 5.0  # used with hexapod offset command
         self.long_timeout = 30.0  # used to wait for in-position event from hexapod
@@ -124,19 +156,11 @@ class LatissCWFSAlign(salobj.BaseScript):
         #         [0.0, -1.0 / 161.0, (107.0/161.0)/4200],
         #         [0.0, 0.0, -1.0 / 4200.0]
         #         ]
-        self.sensitivity_matrix = [
-            [1.0 / 206.0, 0.0, 0.0],
-            [0.0, -1.0 / 206.0, (109.0 / 206.0) / 4200],
-            [0.0, 0.0, -1.0 / 4200.0],
-        ]
-
-        # Rotation matrix to take into account angle between camera and
-        # boresight
-        self.rotation_matrix = lambda angle: np.array(
+        self.sensitivity_matrix = np.array(
             [
-                [np.cos(np.radians(angle)), -np.sin(np.radians(angle)), 0.0],
-                [np.sin(np.radians(angle)), np.cos(np.radians(angle)), 0.0],
-                [0.0, 0.0, 1.0],
+                [1.0 / 206.0, 0.0, 0.0],
+                [0.0, -1.0 / 206.0, (109.0 / 206.0) / 4200],
+                [0.0, 0.0, -1.0 / 4200.0],
             ]
         )
 
@@ -145,11 +169,17 @@ class LatissCWFSAlign(salobj.BaseScript):
         # Measured with data from AT run SUMMIT-5027, still unverified.
         # x-offset measured with images 2021060800432 - 2021060800452
         # y-offset measured with images 2021060800452 - 2021060800472
-        self.hexapod_offset_scale = [
-            [52.459, 0.0, 0.0],
-            [0.0, 50.468, 0.0],
-            [0.0, 0.0, 0.0],
-        ]
+        self.hexapod_offset_scale = np.array(
+            [
+                [52.459, 0.0, 0.0],
+                [0.0, 50.468, 0.0],
+                [0.0, 0.0, 0.0],
+            ]
+        )
+
+        # Both matrices above are constant, so the mapping from de-rotated
+        # zernikes to telescope offsets can be computed once.
+        self._zern_to_tel_offset = self.sensitivity_matrix @ self.hexapod_offset_scale
 
         # Angle between camera and boresight
         # Assume perfect mechanical mounting
@@ -194,6 +224,10 @@ class LatissCWFSAlign(salobj.BaseScript):
         # at the expense of resolution
         self._binning = 1
         self.algo = None
+        # (dz, binning) used to build the current inst/algo, see dz setter
+        self._cwfs_key = None
+        # Cache of (inst, algo) for each (dz, binning) already used
+        self._cwfs_cache = dict()
 
         self.zern = None
         self.hexapod_corr = None
@@ -231,9 +265,24 @@ class LatissCWFSAlign(salobj.BaseScript):
 
     @dz.setter
     def dz(self, value):
+        from lsst.cwfs.instrument import Instrument
+        from lsst.cwfs.algorithm import Algorithm
+
         self._dz = float(value)
+
+        # Only rewrite the configuration and rebuild the CWFS objects if
+        # the parameters they depend on changed.
+        cwfs_key = (self._dz, self.binning)
+        if cwfs_key == self._cwfs_key:
+            return
+
         self.log.info("Using binning factor of {}".format(self.binning))
 
+        if cwfs_key in self._cwfs_cache:
+            self.inst, self.algo = self._cwfs_cache[cwfs_key]
+            self._cwfs_key = cwfs_key
+            return
+
         # Create configuration file with the proper parameters
         cwfs_config_template = """#Auxiliary Telescope parameters:
 Obscuration 				0.423
@@ -243,18 +292,32 @@ Offset (m)				{}
 Pixel_size (m)			{}
 """
         config_index = "auxtel_latiss"
-        path = Path(cwfs.__file__).resolve().parents[3].joinpath("data", config_index)
-        if not path.exists():
-            os.makedirs(path)
+        path = get_cwfs_config_dir(config_index)
         dest = path.joinpath(f"{config_index}.param")
-        with open(dest, "w") as fp:
-            # Write the file and set the offset and pixel size parameters
-            fp.write(
-                cwfs_config_template.format(self._dz * 0.041, 10e-6 * self.binning)
-            )
+        # Set the offset and pixel size parameters
+        cwfs_config = cwfs_config_template.format(
+            self._dz * 0.041, 10e-6 * self.binning
+        )
+        if not dest.exists() or dest.read_text() != cwfs_config:
+            # Write to a temporary file and move it in place, so another
+            # script reading the configuration never sees a partially
+            # written file.
+            fp = tempfile.NamedTemporaryFile("w", dir=path, delete=False)
+            try:
+                with fp:
+                    fp.write(cwfs_config)
+                # NamedTemporaryFile is only readable by its owner, but the
+                # configuration is shared with other users.
+                os.chmod(fp.name, 0o644)
+                os.replace(fp.name, dest)
+            except BaseException:
+                os.unlink(fp.name)
+                raise
 
         self.inst = Instrument(config_index, int(self.side * 2 / self.binning))
         self.algo = Algorithm("exp", self.inst, 1)
+        self._cwfs_cache[cwfs_key] = (self.inst, self.algo)
+        self._cwfs_key = cwfs_key
 
     async def take_intra_extra(self):
         """Take pair of Intra/Extra focal images to be used to determine
@@ -327,19 +390,16 @@ Pixel_size (m)			{}
 
         """
 
-        offset = {
-            "m1": 0.0,
-            "m2": 0.0,
-            "x": x,
-            "y": y,
-            "z": offset,
-            "u": 0.0,
-            "v": 0.0,
-        }
-
         self.atcs.rem.athexapod.evt_positionUpdate.flush()
         await self.atcs.rem.ataos.cmd_offset.set_start(
-            **offset, timeout=self.short_timeout
+            m1=0.0,
+            m2=0.0,
+            x=x,
+            y=y,
+            z=offset,
+            u=0.0,
+            v=0.0,
+            timeout=self.short_timeout,
         )
         await self.atcs.rem.athexapod.evt_positionUpdate.next(
             flush=False, timeout=self.long_timeout
@@ -359,8 +419,7 @@ Pixel_size (m)			{}
         """
 
         # get event loop to run blocking tasks
-        loop = asyncio.get_event_loop()
-        executor = concurrent.futures.ThreadPoolExecutor()
+        loop = asyncio.get_running_loop()
 
         self.cwfs_selected_sources = []
 
@@ -381,16 +440,18 @@ Pixel_size (m)			{}
 
         self.log.debug("Running source detection")
 
-        self.intra_result = await loop.run_in_executor(
-            executor,
-            functools.partial(
-                self.qm.run, self.intra_exposure, donutDiameter=2 * self.side
+        self.intra_result, self.extra_result = await asyncio.gather(
+            loop.run_in_executor(
+                self._executor,
+                functools.partial(
+                    self.qm.run, self.intra_exposure, donutDiameter=2 * self.side
+                ),
             ),
-        )
-        self.extra_result = await loop.run_in_executor(
-            executor,
-            functools.partial(
-                self.qm.run, self.extra_exposure, donutDiameter=2 * self.side
+            loop.run_in_executor(
+                self._executor,
+                functools.partial(
+                    self.qm_extra.run, self.extra_exposure, donutDiameter=2 * self.side
+                ),
             ),
         )
         self.log.debug("Source detection completed")
@@ -430,7 +491,12 @@ Pixel_size (m)			{}
 
         # for a slow telescope, should be running in paraxial mode
         await loop.run_in_executor(
-            executor, self.algo.runIt, self.inst, self.I1[0], self.I2[0], "paraxial"
+            self._executor,
+            self.algo.runIt,
+            self.inst,
+            self.I1[0],
+            self.I2[0],
+            "paraxial",
         )
 
         self.zern = [
@@ -444,49 +510,55 @@ Pixel_size (m)			{}
 
     def create_donut_stamps_for_cwfs(self):
         """Create square stamps with donuts based on centroids."""
+        from lsst.cwfs.image import Image
+
         # reset I1 and I2
         self.I1 = []
         self.I2 = []
 
+        # half size of the stamps, computed from dz on every access
+        side = self.side
+
         ceny, cenx = int(self.intra_result.brightestObjCentroidCofM[1]), int(
             self.intra_result.brightestObjCentroidCofM[0]
         )
         self.log.debug(
             f"Creating stamp for intra_image donut on centroid [y,x] = [{ceny},{cenx}] with a side "
-            f"length of {2 * self.side} pixels"
+            f"length of {2 * side} pixels"
         )
         intra_square = self.intra_exposure.image.array[
-            ceny - self.side : ceny + self.side, cenx - self.side : cenx + self.side
-        ]
+            ceny - side : ceny + side, cenx - side : cenx + side
+        ].astype(np.float32, copy=False)
 
         ceny, cenx = int(self.extra_result.brightestObjCentroidCofM[1]), int(
             self.extra_result.brightestObjCentroidCofM[0]
         )
         self.log.debug(
             f"Creating stamp for intra_image donut on centroid [y,x] = [{ceny},{cenx}] with a side "
-            f"length of {2 * self.side} pixels"
+            f"length of {2 * side} pixels"
         )
 
         extra_square = self.extra_exposure.image.array[
-            ceny - self.side : ceny + self.side, cenx - self.side : cenx + self.side
-        ]
+            ceny - side : ceny + side, cenx - side : cenx + side
+        ].astype(np.float32, copy=False)
 
-        # Bin the images
+        # Bin the images. The ISR output is already float32, so the astype
+        # above only guards against other input types and does not copy.
         if self.binning != 1:
             self.log.info(
                 f"Stamps for analysis will be binned by {self.binning} in each dimension."
             )
-            intra_square0 = copy.deepcopy(intra_square)
-            extra_square0 = copy.deepcopy(extra_square)
             # get tuple array from shape array (which is a tuple) and make
             # an integer
             new_shape = tuple(
                 np.asarray(
-                    np.asarray(intra_square0.shape) / self.binning, dtype=np.int32
+                    np.asarray(intra_square.shape) / self.binning, dtype=np.int32
                 )
             )
-            intra_square = self.rebin(intra_square0, new_shape)
-            extra_square = self.rebin(extra_square0, new_shape)
+            # rebin does not modify its input, so the stamps (views into
+            # the exposures) can be passed directly
+            intra_square = self.rebin(intra_square, new_shape)
+            extra_square = self.rebin(extra_square, new_shape)
             self.log.info(f"intra_square shape is {intra_square.shape}")
             self.log.info(f"extra_square shape is {extra_square.shape}")
 
@@ -518,9 +590,35 @@ Pixel_size (m)			{}
             new_shape[1],
             arr.shape[1] // new_shape[1],
         )
-        rebinned = arr.reshape(shape).mean(-1).mean(1)
+        rebinned = arr.reshape(shape).mean(axis=(1, 3))
         return rebinned
 
+    @staticmethod
+    def rotation_matrix(angle):
+        """Rotation matrix to take into account angle between camera and
+        boresight.
+
+        Parameters
+        ----------
+        angle: `float`
+            Rotation angle (degrees).
+
+        Returns
+        -------
+        matrix: `np.array`
+            3x3 matrix rotating the [x, y] components, leaving the third
+            component unchanged.
+
+        """
+        cos_angle = math.cos(math.radians(angle))
+        sin_angle = math.sin(math.radians(angle))
+        matrix = np.eye(3)
+        matrix[0, 0] = cos_angle
+        matrix[0, 1] = -sin_angle
+        matrix[1, 0] = sin_angle
+        matrix[1, 1] = cos_angle
+        return matrix
+
     def calculate_results(self):
         """Calculates hexapod and telescope offsets based on
         derotated zernikes.
@@ -531,11 +629,11 @@ Pixel_size (m)			{}
             Dictionary of calculated values
 
         """
-        rot_zern = np.matmul(
-            self.zern, self.rotation_matrix(self.angle + self.camera_rotation_angle)
+        rot_zern = np.asarray(self.zern, dtype=float) @ self.rotation_matrix(
+            self.angle + self.camera_rotation_angle
         )
-        hexapod_offset = np.matmul(rot_zern, self.sensitivity_matrix)
-        tel_offset = np.matmul(hexapod_offset, self.hexapod_offset_scale)
+        hexapod_offset = rot_zern @ self.sensitivity_matrix
+        tel_offset = rot_zern @ self._zern_to_tel_offset
 
         self.log.info(
             f"""==============================
@@ -777,3 +875,7 @@ Telescope offsets [arcsec]: {(len(tel_offset) * '{:0.1f}, ').format(*tel_offset)
 
     async def run(self):
         await self.arun(True)
+
+    async def close_tasks(self):
+        await super().close_tasks()
+        self._executor.shutdown(wait=False)
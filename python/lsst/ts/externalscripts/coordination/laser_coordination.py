@@ -21,10 +21,11 @@
 __all__ = ["LaserCoordination"]
 
 from lsst.ts import salobj
-import os
 import asyncio
+import csv
 import datetime
 import yaml
+from pathlib import Path
 
 
 class LaserCoordination(salobj.BaseScript):
@@ -46,8 +47,10 @@ class LaserCoordination(salobj.BaseScript):
     Attributes
     ----------
     wanted_remotes : `list`
-    wavelengths : `range`
+    wavelengths : `tuple` of `int`
+    output_path : `pathlib.Path`
     steps : `int`
+    ls_positions : `tuple` of `int`
     linear_stage_set : `bool`
     linear_stage_2_set : `bool`
     electrometer_set : `bool`
@@ -59,15 +62,19 @@ class LaserCoordination(salobj.BaseScript):
 
     def __init__(self, index, descr=""):
         super().__init__(index, descr="A laser coordination script")
-        self.linear_stage_1 = salobj.Remote(self.domain, name="LinearStage", index=1)
-        self.linear_stage_2 = salobj.Remote(self.domain, name="LinearStage", index=2)
-        self.electrometer = salobj.Remote(self.domain, name="Electrometer", index=1)
-        self.tunable_laser = salobj.Remote(self.domain, name="TunableLaser")
+        # Remotes are created in configure, only for the wanted remotes.
+        self.linear_stage_1 = None
+        self.linear_stage_2 = None
+        self.electrometer = None
+        self.tunable_laser = None
         self.wanted_remotes = None
         self.wavelengths = None
+        self.file_location = None
+        self.output_path = None
         self.steps = None
         self.integration_time = None
         self.max_linear_stage_position = None
+        self.ls_positions = None
         self.linear_stage_set = False
         self.linear_stage_2_set = False
         self.electrometer_set = False
@@ -107,9 +114,20 @@ class LaserCoordination(salobj.BaseScript):
                     items:
                         type: integer
                     additionalItems: false
+                wavelength_list:
+                    description: >-
+                        Explicit list of wavelengths to iterate through, in
+                        order. Used instead of the wavelengths range when set.
+                    anyOf:
+                        - type: array
+                          minItems: 1
+                          items:
+                              type: integer
+                        - type: "null"
+                    default: null
                 file_location:
                     type: string
-                    default: ~
+                    default: "~"
                 steps:
                     type: integer
                     default: 5
@@ -151,8 +169,12 @@ class LaserCoordination(salobj.BaseScript):
             * 'electrometer_remote'
             * 'tunable_laser_remote'
 
-        wavelengths : `range`
-            A range of wavelengths to iterate through. Units: Nanometers
+        wavelengths : `list` of `int`
+            Min and max (exclusive) wavelengths to iterate through, only
+            used with the tunable laser; 525 otherwise. Units: Nanometers
+        wavelength_list : `list` of `int` or `None`
+            Explicit wavelengths to iterate through with the tunable laser,
+            used instead of ``wavelengths`` if not `None`. Units: Nanometers
         file_location
         steps : `int` (the default is 5 mm)
             The amount of mm to move the linear stages by.
@@ -167,26 +189,69 @@ class LaserCoordination(salobj.BaseScript):
         """
         try:
             self.log.debug("START CONFIG")
-            self.wanted_remotes = self.config.wanted_remotes
-            self.wavelengths = range(
-                self.config.wavelengths[0], self.config.wavelengths[1]
-            )
-            self.file_location = os.path.expanduser(self.config.file_location)
-            self.steps = self.config.steps
-            self.max_linear_stage_position = self.config.max_linear_stage_position
-            self.integration_time = self.config.integration_time
-            self.scan_duration = self.config.scan_duration
-            self.timeout = self.config.timeout
-            if "linear_stage_1_remote" in self.wanted_remotes:
-                self.linear_stage_set = True
-            if "linear_stage_2_remote" in self.wanted_remotes:
-                self.linear_stage_2_set = True
-            if "electrometer_remote" in self.wanted_remotes:
+            self.config = config
+            self.wanted_remotes = config.wanted_remotes
+            self.file_location = Path(config.file_location).expanduser()
+            self.output_path = self.file_location / "laser_coordination.txt"
+            self.steps = config.steps
+            self.max_linear_stage_position = config.max_linear_stage_position
+            self.integration_time = config.integration_time
+            self.scan_duration = config.scan_duration
+            self.timeout = config.timeout
+            self.linear_stage_set = "linear_stage_1_remote" in self.wanted_remotes
+            self.linear_stage_2_set = "linear_stage_2_remote" in self.wanted_remotes
+            self.electrometer_set = "electrometer_remote" in self.wanted_remotes
+            self.tunable_laser_set = "tunable_laser_remote" in self.wanted_remotes
+            self.stablization = config.stabilization
+            self.number_of_scans = config.number_of_scans
+
+            if self.stablization:
+                # Repeated electrometer scans with everything else fixed.
+                self.wavelengths = tuple(range(0, int(self.number_of_scans)))
+                self.linear_stage_set = False
+                self.linear_stage_2_set = False
+                self.tunable_laser_set = False
                 self.electrometer_set = True
-            if "tunable_laser_remote" in self.wanted_remotes:
-                self.tunable_laser_set = True
-            self.stablization = self.config.stablization
-            self.number_of_scans = self.config.number_of_scans
+                self.scan_duration = 2
+            elif self.tunable_laser_set:
+                if config.wavelength_list is not None:
+                    self.wavelengths = tuple(config.wavelength_list)
+                else:
+                    self.wavelengths = tuple(
+                        range(config.wavelengths[0], config.wavelengths[1])
+                    )
+            else:
+                self.wavelengths = (525,)
+
+            if not self.linear_stage_set or not self.linear_stage_2_set:
+                self.max_linear_stage_position = 2
+                self.steps = 1
+            self.ls_positions = tuple(
+                range(1, self.max_linear_stage_position, self.steps)
+            )
+
+            # Each remote sets up DDS readers and writers, so only create
+            # the ones the scan uses.
+            new_remotes = []
+            if self.linear_stage_set and self.linear_stage_1 is None:
+                self.linear_stage_1 = salobj.Remote(
+                    self.domain, name="LinearStage", index=1
+                )
+                new_remotes.append(self.linear_stage_1)
+            if self.linear_stage_2_set and self.linear_stage_2 is None:
+                self.linear_stage_2 = salobj.Remote(
+                    self.domain, name="LinearStage", index=2
+                )
+                new_remotes.append(self.linear_stage_2)
+            if self.electrometer_set and self.electrometer is None:
+                self.electrometer = salobj.Remote(
+                    self.domain, name="Electrometer", index=1
+                )
+                new_remotes.append(self.electrometer)
+            if self.tunable_laser_set and self.tunable_laser is None:
+                self.tunable_laser = salobj.Remote(self.domain, name="TunableLaser")
+                new_remotes.append(self.tunable_laser)
+            await asyncio.gather(*[remote.start_task for remote in new_remotes])
             self.log.debug("END CONFIG")
         except Exception as e:
             self.log.exception(e)
@@ -204,102 +269,210 @@ class LaserCoordination(salobj.BaseScript):
         }
         return metadata
 
-    async def run(self):
-        async def setup_electrometers():
-            self.electrometer.cmd_setMode.set(mode=1)
-            self.electrometer.cmd_setIntegrationTime.set(intTime=self.integration_time)
-            await self.electrometer.cmd_setMode.start(timeout=self.timeout)
-            await self.electrometer.cmd_setIntegrationTime.start(timeout=self.timeout)
+    async def setup_electrometer(self):
+        """Set the electrometer mode, then its integration time.
+
+        The integration time applies to the current mode, so the two
+        commands must be sent in this order.
+        """
+        await self.electrometer.cmd_setMode.set_start(mode=1, timeout=self.timeout)
+        await self.electrometer.cmd_setIntegrationTime.set_start(
+            intTime=self.integration_time, timeout=self.timeout
+        )
+
+    async def start_electrometer_scan(self):
+        """Take an electrometer scan, without waiting for its data.
+
+        Returns once the electrometer is done integrating, so the stages can
+        be moved, while the scan data is still being published.
+
+        Returns
+        -------
+        data_task : `asyncio.Task`
+            Task that returns the ``largeFileObjectAvailable`` event with
+            the scan data.
+        """
+        # Start waiting for the data before the scan, so it cannot be
+        # missed.
+        self.electrometer.evt_largeFileObjectAvailable.flush()
+        data_task = asyncio.create_task(
+            self.electrometer.evt_largeFileObjectAvailable.next(
+                flush=False, timeout=self.timeout + self.scan_duration
+            )
+        )
+        try:
+            await self.electrometer.cmd_startScanDt.set_start(
+                scanDuration=self.scan_duration, timeout=self.timeout
+            )
+            # The scan has started, at the latest, when the command is
+            # acknowledged, so it is done integrating after scan_duration.
+            await asyncio.sleep(self.scan_duration)
+        except BaseException:
+            data_task.cancel()
+            raise
+        return data_task
+
+    async def finish_electrometer_scan(self, data_task, data_row):
+        """Wait for the data of a scan started with
+        `start_electrometer_scan`.
+
+        Parameters
+        ----------
+        data_task : `asyncio.Task`
+            Task returned by `start_electrometer_scan`.
+        data_row : `list`
+            Timestamp, wavelength and linear stage positions of the scan.
+
+        Returns
+        -------
+        data_row : `list`
+            The input row, with the url of the scan data appended.
+        """
+        electrometer_data = await data_task
+        return data_row + [electrometer_data.url]
+
+    def scan_cells(self):
+        """Get the cells of the scan, in serpentine order.
+
+        Linear stage 2 reverses direction on every row, and linear stage 1
+        on every wavelength, so neither stage has to travel back to its
+        first position.
 
+        Yields
+        ------
+        cell : `tuple`
+            Wavelength, linear stage 1 and linear stage 2 positions.
+        """
+        orders = (self.ls_positions, self.ls_positions[::-1])
+        row = 0
+        for wavelength_index, wavelength in enumerate(self.wavelengths):
+            for ls_pos in orders[wavelength_index % 2]:
+                for ls_2_pos in orders[row % 2]:
+                    yield wavelength, ls_pos, ls_2_pos
+                row += 1
+
+    async def gather_or_cancel(self, *coros):
+        """Run coroutines concurrently, cancelling all of them if one fails.
+
+        Parameters
+        ----------
+        *coros : `coroutine`
+            Coroutines to run.
+
+        Returns
+        -------
+        results : `list`
+            Results of the coroutines, in order.
+        """
+        tasks = [asyncio.create_task(coro) for coro in coros]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def run(self):
         setup_tasks = []
-        if not self.tunable_laser_set and not self.stablization:
-            self.wavelengths = [
-                525,
-            ]
-        if self.stablization:
-            self.wavelengths = range(0, self.number_of_scans)
-            self.linear_stage_set = False
-            self.linear_stage_2_set = False
-            self.tunable_laser_set = False
-            self.electrometer_set = True
-            self.scan_duration = 2
-
-        if not self.linear_stage_set:
-            self.max_linear_stage_position = 2
-            self.steps = 1
-        if not self.linear_stage_2_set:
-            self.max_linear_stage_position = 2
-            self.steps = 1
         if self.tunable_laser_set:
             propagate_state_ack = self.tunable_laser.cmd_startPropagateLaser.start(
                 timeout=self.timeout
             )
             setup_tasks.append(propagate_state_ack)
         if self.electrometer_set:
-            setup_electrometer_ack_coro = setup_electrometers()
-            setup_tasks.append(setup_electrometer_ack_coro)
+            setup_tasks.append(self.setup_electrometer())
         try:
-            data_array = []
             self.log.debug("Setting up Script")
-            await asyncio.gather(*setup_tasks)
+            await self.gather_or_cancel(*setup_tasks)
             await self.checkpoint("setup complete")
             self.log.debug("Finished setting up script")
-            for wavelength in self.wavelengths:
-                for ls_pos in range(1, self.max_linear_stage_position, self.steps):
-                    if self.linear_stage_set:
-                        self.linear_stage_1.cmd_moveAbsolute.set(distance=ls_pos)
-                        self.log.debug("Moving linear stage 1")
-                        await self.linear_stage_1.cmd_moveAbsolute.start(
-                            timeout=self.timeout
-                        )
-                    await self.checkpoint(f"ls 1 pos: {ls_pos}")
-                    for ls_2_pos in range(
-                        1, self.max_linear_stage_position, self.steps
-                    ):
+            # Rows are written as soon as the data is available, so partial
+            # results are kept if the scan fails.
+            with self.output_path.open("w", newline="", buffering=1) as f:
+                writer = csv.writer(f)
+                writer.writerow(
+                    [
+                        "timestamp",
+                        "wavelength",
+                        "ls_pos",
+                        "ls_2_pos",
+                        "electrometer_data_url",
+                    ]
+                )
+                # Data task and data row of the last electrometer scan. The
+                # data is published while the stages move to the next cell.
+                pending_scan = None
+                try:
+                    # Position of linear stage 1, only move it when it
+                    # changes.
+                    current_ls_pos = None
+                    for wavelength, ls_pos, ls_2_pos in self.scan_cells():
+                        moves = []
+                        if ls_pos != current_ls_pos:
+                            if self.linear_stage_set:
+                                self.log.debug("Moving linear stage 1 to %s", ls_pos)
+                                # The stages are independent, linear stage 1
+                                # moves together with linear stage 2.
+                                moves.append(
+                                    self.linear_stage_1.cmd_moveAbsolute.set_start(
+                                        distance=ls_pos, timeout=self.timeout
+                                    )
+                                )
+                            current_ls_pos = ls_pos
                         if self.linear_stage_2_set:
-                            self.linear_stage_2.cmd_moveAbsolute.set(distance=ls_2_pos)
-                            self.log.debug("moving linear stage 2")
-                            await self.linear_stage_2.cmd_moveAbsolute.start(
-                                timeout=self.timeout
-                            )
-                        elif not self.linear_stage_2_set and self.stablization:
-                            await asyncio.sleep(10)
-                        await self.checkpoint(f"ls 1 pos {ls_pos} ls 2 pos: {ls_2_pos}")
-                        if self.electrometer_set:
-                            electrometer_data_coro = (
-                                self.electrometer.evt_largeFileObjectAvailable.next(
-                                    flush=True, timeout=self.timeout
+                            self.log.debug("Moving linear stage 2 to %s", ls_2_pos)
+                            moves.append(
+                                self.linear_stage_2.cmd_moveAbsolute.set_start(
+                                    distance=ls_2_pos, timeout=self.timeout
                                 )
                             )
-                            self.electrometer.cmd_startScanDt.set(
-                                scanDuration=self.scan_duration
-                            )
-                            await self.electrometer.cmd_startScanDt.start(
-                                timeout=self.timeout
+                        elif self.stablization:
+                            await asyncio.sleep(10)
+                        await self.gather_or_cancel(*moves)
+                        if pending_scan is not None:
+                            writer.writerow(
+                                await self.finish_electrometer_scan(*pending_scan)
                             )
-                            electrometer_data = await electrometer_data_coro
-                            await self.checkpoint(
-                                f"ls 1 pos {ls_pos} ls 2 pos {ls_2_pos} electr. data"
+                            pending_scan = None
+                        if self.electrometer_set:
+                            data_task = await self.start_electrometer_scan()
+                            pending_scan = (
+                                data_task,
+                                [datetime.datetime.now(), wavelength, ls_pos, ls_2_pos],
                             )
-                            data_array.append(
-                                [
-                                    datetime.datetime.now(),
-                                    wavelength,
-                                    ls_pos,
-                                    ls_2_pos,
-                                    electrometer_data.url,
-                                ]
+                        # One checkpoint per cell, while the stages are still
+                        # on it and its scan (if any) is done.
+                        await self.checkpoint(f"ls 1 pos {ls_pos} ls 2 pos: {ls_2_pos}")
+                    if pending_scan is not None:
+                        writer.writerow(
+                            await self.finish_electrometer_scan(*pending_scan)
+                        )
+                        pending_scan = None
+                finally:
+                    # Keep the row of a scan that is already done, e.g. if
+                    # the script is stopped at the checkpoint after it.
+                    if pending_scan is not None:
+                        data_task = pending_scan[0]
+                        if not data_task.done():
+                            data_task.cancel()
+                            await asyncio.gather(data_task, return_exceptions=True)
+                        elif (
+                            not data_task.cancelled() and data_task.exception() is None
+                        ):
+                            writer.writerow(
+                                await self.finish_electrometer_scan(*pending_scan)
                             )
+                        pending_scan = None
+        except Exception:
+            self.log.exception("Laser coordination failed.")
+            raise
+        finally:
+            # Never leave the laser propagating, even if the scan failed
+            # or the script was stopped.
             if self.tunable_laser_set:
-                self.tunable_laser.cmd_stopPropagateLaser.set()
-                await self.tunable_laser.cmd_stopPropagateLaser.start(
+                await self.tunable_laser.cmd_stopPropagateLaser.set_start(
                     timeout=self.timeout
                 )
-                await self.checkpoint("Laser stopped propagating")
-            with open(f"{self.file_location}laser_coordination.txt", "w") as f:
-                f.write("timestamp wavelength ls_pos ls_2_pos electrometer_data_url\n")
-                for line in data_array:
-                    f.write(f"{line[0]} {line[1]}, {line[2]}, {line[3]}, {line[4]}\n")
-        except Exception as e:
-            print(e)
-            raise
+        if self.tunable_laser_set:
+            await self.checkpoint("Laser stopped propagating")
@@ -23,4 +23,12 @@ import asyncio
 
 from lsst.ts.externalscripts.coordination import LaserCoordination
 
+# uvloop is optional, use it when available for a faster event loop
+try:
+    import uvloop
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 asyncio.run(LaserCoordination.amain())
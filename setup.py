@@ -10,19 +10,28 @@ dev_requires = install_requires + tests_require + ["documenteer[pipelines]"]
 tools_path = pathlib.PurePosixPath(setuptools.__path__[0])
 base_prefix = pathlib.PurePosixPath(sys.base_prefix)
 data_files_path = tools_path.relative_to(base_prefix).parents[1]
-data_files = []
-
-for dirpath, dirnames, filenames in os.walk(
-    "scripts/", topdown=True, followlinks=False
-):
-    dirnames[:] = [name for name in dirnames if not name.startswith(".")]
-    destination = os.path.join(data_files_path, dirpath)
-    script_files = [
-        os.path.join(dirpath, filename)
-        for filename in filenames
-        if filename[0] not in (".", "_")
-    ]
-    data_files.append((destination, script_files))
+
+
+def iter_script_files(dirpath):
+    """Yield (destination, script_files) for dirpath and its subdirectories,
+    skipping hidden directories and hidden or private files.
+    """
+    script_files = []
+    subdirs = []
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                # Like os.walk(followlinks=False): skip links to directories
+                if entry.name[0] != "." and not entry.is_symlink():
+                    subdirs.append(entry.path)
+            elif entry.name[0] not in (".", "_"):
+                script_files.append(entry.path)
+    yield os.path.join(data_files_path, dirpath), script_files
+    for subdir in subdirs:
+        yield from iter_script_files(subdir)
+
+
+data_files = list(iter_script_files("scripts/"))
 
 scm_version_template = """# Generated by setuptools_scm
 __all__ = ["__version__"]
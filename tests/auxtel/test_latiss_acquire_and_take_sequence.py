@@ -29,6 +29,9 @@ from lsst.ts import salobj
 from lsst.ts import standardscripts
 from lsst.ts import externalscripts
 from lsst.ts.externalscripts.auxtel import LatissAcquireAndTakeSequence
+from lsst.ts.externalscripts.auxtel.latiss_acquire_and_take_sequence import (
+    broadcast_sequence,
+)
 import lsst.daf.persistence as dafPersist
 import logging
 
@@ -578,5 +581,28 @@ class TestLatissAcquireAndTakeSequence(
         await self.check_executable(script_path)
 
 
+class TestBroadcastSequence(unittest.TestCase):
+    def test_scalar(self):
+        self.assertEqual(broadcast_sequence(1.0, 3).tolist(), [1.0, 1.0, 1.0])
+        self.assertEqual(
+            broadcast_sequence("empty_1", 2).tolist(), ["empty_1", "empty_1"]
+        )
+
+    def test_single_element(self):
+        self.assertEqual(broadcast_sequence([2.0], 3).tolist(), [2.0, 2.0, 2.0])
+
+    def test_matching_length(self):
+        self.assertEqual(
+            broadcast_sequence(["a", "b", "c"], 3).tolist(), ["a", "b", "c"]
+        )
+
+    def test_length_mismatch(self):
+        with self.assertRaises(ValueError):
+            broadcast_sequence([1.0, 2.0], 3)
+
+        with self.assertRaises(ValueError):
+            broadcast_sequence([1.0, 2.0, 3.0], 2)
+
+
 if __name__ == "__main__":
     unittest.main()
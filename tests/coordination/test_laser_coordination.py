@@ -1,5 +1,11 @@
+import asyncio
+import csv
 import logging
+import pathlib
+import tempfile
+import types
 import unittest
+import unittest.mock
 
 import numpy as np
 import yaml
@@ -39,6 +45,298 @@ class TestLaserCoordination(unittest.IsolatedAsyncioTestCase):
                     config_data.config = yaml.safe_dump(kwargs)
                 await script.do_configure(config_data)
 
+            all_remotes = [
+                "linear_stage_1_remote",
+                "linear_stage_2_remote",
+                "electrometer_remote",
+                "tunable_laser_remote",
+            ]
+
+            with tempfile.TemporaryDirectory() as data_dir:
+                # Tunable laser: scan the configured wavelength range
+                await run_configure(
+                    wanted_remotes=all_remotes,
+                    wavelengths=[500, 503],
+                    file_location=data_dir,
+                    steps=10,
+                    max_linear_stage_position=40,
+                )
+                self.assertEqual(script.wavelengths, (500, 501, 502))
+                self.assertEqual(script.ls_positions, (1, 11, 21, 31))
+                self.assertEqual(
+                    script.output_path,
+                    pathlib.Path(data_dir) / "laser_coordination.txt",
+                )
+                self.assertIsNotNone(script.linear_stage_1)
+                self.assertIsNotNone(script.linear_stage_2)
+                self.assertIsNotNone(script.electrometer)
+                self.assertIsNotNone(script.tunable_laser)
+
+                # Tunable laser with an explicit, non-contiguous list
+                await run_configure(
+                    wanted_remotes=all_remotes,
+                    wavelengths=[500, 503],
+                    wavelength_list=[700, 500, 650],
+                    file_location=data_dir,
+                )
+                self.assertEqual(script.wavelengths, (700, 500, 650))
+
+        index = next(index_gen)
+
+        async with LaserCoordination(index=index) as script:
+            # No tunable laser: a single 525 nm wavelength and default
+            # output location.
+            await run_configure(
+                wanted_remotes=all_remotes[:3],
+                wavelengths=[500, 503],
+                steps=10,
+                max_linear_stage_position=40,
+            )
+            self.assertEqual(script.wavelengths, (525,))
+            self.assertEqual(script.ls_positions, (1, 11, 21, 31))
+            self.assertEqual(
+                script.output_path,
+                pathlib.Path("~").expanduser() / "laser_coordination.txt",
+            )
+            self.assertIsNotNone(script.linear_stage_1)
+            self.assertIsNotNone(script.linear_stage_2)
+            self.assertIsNotNone(script.electrometer)
+            self.assertIsNone(script.tunable_laser)
+
+            # The wavelength list is only used with the tunable laser
+            await run_configure(
+                wanted_remotes=all_remotes[:3],
+                wavelengths=[500, 503],
+                wavelength_list=[700, 500],
+            )
+            self.assertEqual(script.wavelengths, (525,))
+
+            # Only one linear stage: a single stage position
+            await run_configure(
+                wanted_remotes=["linear_stage_1_remote", "electrometer_remote"],
+                wavelengths=[500, 503],
+            )
+            self.assertEqual(script.ls_positions, (1,))
+            self.assertFalse(script.linear_stage_2_set)
+            self.assertFalse(script.tunable_laser_set)
+
+        index = next(index_gen)
+
+        async with LaserCoordination(index=index) as script:
+            # Stabilization: repeated electrometer scans, nothing else
+            await run_configure(
+                wanted_remotes=all_remotes,
+                wavelengths=[500, 503],
+                stabilization=True,
+                number_of_scans=3,
+            )
+            self.assertEqual(script.wavelengths, (0, 1, 2))
+            self.assertEqual(script.ls_positions, (1,))
+            self.assertEqual(script.scan_duration, 2)
+            self.assertTrue(script.electrometer_set)
+            self.assertFalse(script.linear_stage_set)
+            self.assertFalse(script.linear_stage_2_set)
+            self.assertFalse(script.tunable_laser_set)
+            self.assertIsNotNone(script.electrometer)
+            self.assertIsNone(script.linear_stage_1)
+            self.assertIsNone(script.linear_stage_2)
+            self.assertIsNone(script.tunable_laser)
+
+    async def configure_with_mock_remotes(self, script, data_dir):
+        """Configure the script for a 2 x 2 x 2 scan with mocked remotes."""
+        # configure only creates the remotes that are not set yet.
+        script.linear_stage_1 = unittest.mock.MagicMock()
+        script.linear_stage_2 = unittest.mock.MagicMock()
+        script.electrometer = unittest.mock.MagicMock()
+        script.tunable_laser = unittest.mock.MagicMock()
+        for remote in (script.linear_stage_1, script.linear_stage_2):
+            remote.cmd_moveAbsolute.set_start = unittest.mock.AsyncMock()
+        for command in ("setMode", "setIntegrationTime", "startScanDt"):
+            getattr(script.electrometer, f"cmd_{command}").set_start = (
+                unittest.mock.AsyncMock()
+            )
+        script.electrometer.evt_largeFileObjectAvailable.next = unittest.mock.AsyncMock(
+            side_effect=[types.SimpleNamespace(url=f"url{i}") for i in range(8)]
+        )
+        script.tunable_laser.cmd_startPropagateLaser.start = unittest.mock.AsyncMock()
+        script.tunable_laser.cmd_stopPropagateLaser.set_start = (
+            unittest.mock.AsyncMock()
+        )
+        script.checkpoint = unittest.mock.AsyncMock()
+
+        config_data = script.cmd_configure.DataType()
+        config_data.config = yaml.safe_dump(
+            dict(
+                wanted_remotes=[
+                    "linear_stage_1_remote",
+                    "linear_stage_2_remote",
+                    "electrometer_remote",
+                    "tunable_laser_remote",
+                ],
+                wavelengths=[500, 502],
+                file_location=data_dir,
+                steps=1,
+                max_linear_stage_position=3,
+                scan_duration=0,
+            )
+        )
+        await script.do_configure(config_data)
+
+    def read_rows(self, script):
+        with script.output_path.open(newline="") as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(
+            rows[0],
+            ["timestamp", "wavelength", "ls_pos", "ls_2_pos", "electrometer_data_url"],
+        )
+        return rows[1:]
+
+    async def test_run(self):
+        index = next(index_gen)
+
+        async with LaserCoordination(index=index) as script:
+            with tempfile.TemporaryDirectory() as data_dir:
+                await self.configure_with_mock_remotes(script, data_dir)
+
+                await script.run()
+
+                cells = list(script.scan_cells())
+                rows = self.read_rows(script)
+                self.assertEqual(
+                    [(int(row[1]), int(row[2]), int(row[3])) for row in rows], cells
+                )
+                self.assertEqual(
+                    [row[4] for row in rows], [f"url{i}" for i in range(len(cells))]
+                )
+                # Linear stage 1 only moves when its position changes.
+                self.assertEqual(
+                    script.linear_stage_1.cmd_moveAbsolute.set_start.await_count, 3
+                )
+                self.assertEqual(
+                    script.linear_stage_2.cmd_moveAbsolute.set_start.await_count,
+                    len(cells),
+                )
+                script.tunable_laser.cmd_startPropagateLaser.start.assert_awaited_once()
+                script.tunable_laser.cmd_stopPropagateLaser.set_start.assert_awaited_once()
+
+    async def test_run_move_fails(self):
+        index = next(index_gen)
+
+        async with LaserCoordination(index=index) as script:
+            with tempfile.TemporaryDirectory() as data_dir:
+                await self.configure_with_mock_remotes(script, data_dir)
+
+                # Linear stage 1 fails on its second move, at the third
+                # cell, while linear stage 2 is moving and the data of the
+                # second cell has not arrived.
+                script.linear_stage_1.cmd_moveAbsolute.set_start.side_effect = [
+                    None,
+                    RuntimeError("Move failed"),
+                ]
+                cancelled = set()
+
+                async def wait_forever(name):
+                    try:
+                        await asyncio.Event().wait()
+                    except asyncio.CancelledError:
+                        cancelled.add(name)
+                        raise
+
+                async def move_linear_stage_2(distance, timeout):
+                    if move_linear_stage_2.calls == 2:
+                        await wait_forever("move")
+                    move_linear_stage_2.calls += 1
+
+                move_linear_stage_2.calls = 0
+                script.linear_stage_2.cmd_moveAbsolute.set_start.side_effect = (
+                    move_linear_stage_2
+                )
+
+                async def next_data(flush, timeout):
+                    if next_data.calls == 1:
+                        await wait_forever("data")
+                    next_data.calls += 1
+                    return types.SimpleNamespace(url="url0")
+
+                next_data.calls = 0
+                script.electrometer.evt_largeFileObjectAvailable.next.side_effect = (
+                    next_data
+                )
+
+                with self.assertRaisesRegex(RuntimeError, "Move failed"):
+                    await script.run()
+
+                self.assertEqual(cancelled, {"move", "data"})
+                rows = self.read_rows(script)
+                self.assertEqual([row[1:] for row in rows], [["500", "1", "1", "url0"]])
+                script.tunable_laser.cmd_stopPropagateLaser.set_start.assert_awaited_once()
+
+
+class TestScanCells(unittest.TestCase):
+    def scan_cells(self, wavelengths, ls_positions):
+        config = types.SimpleNamespace(
+            wavelengths=wavelengths, ls_positions=ls_positions
+        )
+        return list(LaserCoordination.scan_cells(config))
+
+    def assert_no_move_between_wavelengths(self, cells):
+        for previous, current in zip(cells, cells[1:]):
+            if current[0] != previous[0]:
+                self.assertEqual(current[1:], previous[1:])
+
+    def test_odd_rows(self):
+        cells = self.scan_cells((500, 501), (1, 2, 3))
+        self.assertEqual(
+            cells,
+            [
+                (500, 1, 1),
+                (500, 1, 2),
+                (500, 1, 3),
+                (500, 2, 3),
+                (500, 2, 2),
+                (500, 2, 1),
+                (500, 3, 1),
+                (500, 3, 2),
+                (500, 3, 3),
+                (501, 3, 3),
+                (501, 3, 2),
+                (501, 3, 1),
+                (501, 2, 1),
+                (501, 2, 2),
+                (501, 2, 3),
+                (501, 1, 3),
+                (501, 1, 2),
+                (501, 1, 1),
+            ],
+        )
+        self.assert_no_move_between_wavelengths(cells)
+
+    def test_even_rows(self):
+        cells = self.scan_cells((500, 501, 502), (1, 2))
+        self.assertEqual(
+            cells,
+            [
+                (500, 1, 1),
+                (500, 1, 2),
+                (500, 2, 2),
+                (500, 2, 1),
+                (501, 2, 1),
+                (501, 2, 2),
+                (501, 1, 2),
+                (501, 1, 1),
+                (502, 1, 1),
+                (502, 1, 2),
+                (502, 2, 2),
+                (502, 2, 1),
+            ],
+        )
+        self.assert_no_move_between_wavelengths(cells)
+
+    def test_single_position(self):
+        self.assertEqual(
+            self.scan_cells((0, 1, 2), (1,)), [(0, 1, 1), (1, 1, 1), (2, 1, 1)]
+        )
+
 
 if __name__ == "__main__":
     unittest.main()